@@ -3,27 +3,40 @@ Advanced Telegram Dating Bot (single-file Render-ready)
 
 Features:
 - Flask + webhook (works with gunicorn on Render)
-- Telegram channel pinned-message as JSON DB
+- Telegram channel pinned document as JSON DB (zlib-compressed)
 - Registration with photo, name, age, gender, interest, city, bio
 - VIP vs Free (fake profiles for free users)
 - Browse, Like, Skip, Matches, Likes-you
 - Admin panel: /init_db (safe), /grant_vip, /revoke_vip, /broadcast, /delete_user
 - Reply keyboard + Inline keyboards
-- Safe DB save (checks message size)
+- Safe DB save (checks file size)
 - Health endpoints for Render
 """
 
 import os
 import time
-import json
+import base64
+import zlib
 import logging
 import random
-from typing import Dict, Any
-
+import heapq
+import itertools
+import functools
+import re
+from html import escape, unescape
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional
+
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flask import Flask, request
 import telebot
+from telebot import apihelper
 # This line lists the specific types needed for your bot's keyboards
-from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton, InputMediaDocument, InputMediaPhoto
 # This line is the fix we added previously for error logging (it is now clean)
 from telebot.apihelper import ApiTelegramException
 # ---------------- logging ----------------
@@ -34,7 +47,18 @@ logger = logging.getLogger("dating-bot")
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 DB_CHANNEL_ID = os.getenv("DB_CHANNEL_ID")  # e.g. -1001234567890
 ADMIN_IDS_ENV = os.getenv("ADMIN_IDS", "")
-ADMIN_IDS = [int(x) for x in ADMIN_IDS_ENV.split(",") if x.strip().isdigit()]
+ADMIN_IDS = frozenset(int(x) for x in ADMIN_IDS_ENV.split(",") if x.strip().isdigit())
+# Fixed after startup, so the admin mention list and /help text are built once
+ADMIN_HTML = ", ".join(f"<a href='tg://user?id={a}'>{a}</a>" for a in sorted(ADMIN_IDS))
+HELP_TEXT = (
+    "<b>Commands</b>\n"
+    "/start – create your profile or see the menu\n"
+    "/profile – show your profile\n"
+    "/profiles – browse profiles\n"
+    "/matches – list your matches\n\n"
+    f"Admins: {ADMIN_HTML or 'none'}\n"
+    "Use the buttons to navigate."
+)
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # e.g. https://your-app.onrender.com
 
 if not BOT_TOKEN or not DB_CHANNEL_ID or not WEBHOOK_URL:
@@ -42,12 +66,50 @@ if not BOT_TOKEN or not DB_CHANNEL_ID or not WEBHOOK_URL:
     raise SystemExit("Set BOT_TOKEN, DB_CHANNEL_ID, WEBHOOK_URL as env vars before running.")
 
 # ---------------- bot + flask ----------------
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML")
+HTTP_POOL_SIZE = 32  # keep-alive connections to api.telegram.org shared by all threads
+
+# One pooled session for every Bot API call instead of telebot's per-thread sessions,
+# so handlers reuse warm TLS connections. Retry never re-sends a POST that reached the server.
+_http_session = requests.Session()
+_http_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE,
+                                            max_retries=Retry(total=2, backoff_factor=0.1)))
+apihelper.session = _http_session
+apihelper.SESSION_TIME_TO_LIVE = None  # never recycle the shared session
+
+# threaded=False: handlers run on our per-chat update shards (see webhook) instead of telebot's pool
+bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML", threaded=False)
 app = Flask(__name__)
 
 # ---------------- in-memory registration state ----------------
+# Per-process: the Procfile pins gunicorn to one worker so every update of a
+# registration reaches the same dicts (and the same per-chat update shard).
 REG_STEP: Dict[int, str] = {}
 TEMP_BUFFER: Dict[int, Dict[str, Any]] = {}
+REG_STARTED: Dict[int, float] = {}  # monotonic start time, oldest first; used to evict abandoned registrations
+REG_TTL = 3600  # seconds an unfinished registration is kept
+
+def _clear_registration(uid: int):
+    REG_STEP.pop(uid, None)
+    TEMP_BUFFER.pop(uid, None)
+    REG_STARTED.pop(uid, None)
+
+def _start_registration(uid: int):
+    # Sweep abandoned registrations here so the dicts stay bounded without a timer thread.
+    # REG_STARTED is kept in start order, so the sweep stops at the first live entry.
+    cutoff = time.monotonic() - REG_TTL
+    evicted = 0
+    while REG_STARTED:
+        stale_uid, started = next(iter(REG_STARTED.items()))
+        if started >= cutoff:
+            break
+        _clear_registration(stale_uid)
+        evicted += 1
+    if evicted:
+        logger.info("Evicted %d abandoned registrations.", evicted)
+    REG_STARTED.pop(uid, None)  # a restart moves the user to the end
+    TEMP_BUFFER[uid] = {"tgid": uid}
+    REG_STEP[uid] = "photo"
+    REG_STARTED[uid] = time.monotonic()
 
 # ---------------- fake profiles ----------------
 FAKE_PROFILES_MALE = [
@@ -60,10 +122,39 @@ FAKE_PROFILES_FEMALE = [
 ]
 
 # ---------------- DB helpers (channel pinned message) ----------------
-DB_CHAR_LIMIT = 3800  # safe margin under Telegram message limit
+# The DB is a zlib-compressed JSON document pinned in the channel; a document is edited in
+# place like the old text message but is not bound by the 4096-char text limit.
+DB_FILE_NAME = "dating-bot-db.json.z"
+DB_MAX_BYTES = 20 * 1024 * 1024  # getFile only serves bot downloads up to 20 MB
+DB_PACKED_PREFIX = "z:"  # legacy pinned-text format (zlib+base85); plain JSON text is read too
+DB_PIN_RETRIES = 3
+DB_CACHE_TTL = 30.0  # seconds before the pinned DB is re-read; this process is its only writer
+
+# Parsed DB shared by all handlers; spares a get_chat round-trip + JSON parse per lookup.
+# "pinned_id" is the DB message id, so saves can edit it without a get_chat call.
+# "file_uid" is the file_unique_id of the DB document last read or written; a TTL refresh
+# that finds the same file pinned keeps the cached dict instead of downloading it again.
+# "names" maps int user id -> display name for listing matches.
+# "by_id" maps int user id -> the same record dicts as db["users"] (whose keys are JSON
+# strings), so lookups by a Telegram id don't stringify it first.
+# "index" maps a gender ("Male"/"Female", or "both") to parallel (ids, records) lists of
+# registered users, so browsing picks a candidate without scanning every user; a
+# (gender, looking_for) key holds the subset of that gender seeking a given gender.
+# "loaded" is set once "db" comes from a successful read of the channel; until then
+# nothing may be saved, or a placeholder would replace the real pinned DB.
+_DB_CACHE: Dict[str, Any] = {"db": None, "ts": 0.0, "index": {}, "names": {}, "by_id": {}, "pinned_id": None, "file_uid": None, "loaded": False}
+_DB_LOCK = threading.RLock()
+# Saves are uploaded by one writer thread. "batch" collects the saves staged since the
+# writer last took a snapshot; they all go out in its next upload ("busy" while one is
+# in flight), so concurrent saves cost one editMessageMedia instead of one each.
+_DB_COND = threading.Condition(_DB_LOCK)
+_DB_FLUSH: Dict[str, Any] = {"batch": None, "busy": False}
 
 def _get_pinned_message():
-    """Return pinned_message object or None. Handles API errors gracefully."""
+    """
+    Return pinned_message object or None if nothing is pinned.
+    API/network errors are logged and re-raised, so callers can tell them apart from an empty channel.
+    """
     if not DB_CHANNEL_ID:
         return None
     try:
@@ -76,81 +167,345 @@ def _get_pinned_message():
         logger.error("API ERROR in DB access. Code: %s, Description: %s", 
                      e.error_code, e.description)
         logger.error("SOLUTION: Ensure the bot is an ADMIN in the channel (%s) with 'Post' and 'Pin' permissions.", DB_CHANNEL_ID)
-        return None
+        raise
     except Exception as e:
         logger.exception("Failed to get pinned message (UNKNOWN ERROR): %s", e)
-        return None
+        raise
 
-def load_db() -> Dict[str, Any]:
+# Per-user id collections: JSON lists on the channel, sets in memory for O(1) membership checks
+SET_FIELDS = ("likes", "matches")
+
+def _json_default(obj):
+    if isinstance(obj, set):
+        return list(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+def _pack_db(db: Dict[str, Any]) -> bytes:
+    return zlib.compress(orjson.dumps(db, default=_json_default, option=orjson.OPT_NON_STR_KEYS), 9)
+
+def _unpack_db(data: bytes) -> Dict[str, Any]:
+    return orjson.loads(zlib.decompress(data))
+
+def _unpack_db_text(text: str) -> Dict[str, Any]:
+    # DBs saved before the move to a document; replaced by a document on the next save
+    if text.startswith(DB_PACKED_PREFIX):
+        return _unpack_db(base64.b85decode(text[len(DB_PACKED_PREFIX):]))
+    return orjson.loads(text)
+
+def _fetch_db() -> Optional[Dict[str, Any]]:
     """
     Load DB JSON from pinned message. If not found or invalid, returns default structure.
+    Returns None if the channel couldn't be read (API/network error), so a transient
+    failure is never mistaken for an empty DB.
     """
     try:
         pinned = _get_pinned_message()
-        if pinned and getattr(pinned, "text", None):
-            try:
-                return json.loads(pinned.text)
-            except Exception as e:
-                logger.warning("Pinned message JSON parse error: %s", e)
-                return {"users": {}, "meta": {}}
-        return {"users": {}, "meta": {}}
-    except Exception as e:
-        logger.exception("load_db error: %s", e)
-        return {"users": {}, "meta": {}}
+    except Exception:
+        return None  # logged by _get_pinned_message()
+    document = getattr(pinned, "document", None)
+    if document:
+        if document.file_unique_id == _DB_CACHE["file_uid"] and _DB_CACHE["db"] is not None:
+            # Same file as our last read/write: skip getFile + download
+            _DB_CACHE["pinned_id"] = pinned.message_id
+            return _DB_CACHE["db"]
+        try:
+            data = bot.download_file(bot.get_file(document.file_id).file_path)
+        except Exception as e:
+            logger.warning("Pinned DB document download error: %s", e)
+            return None
+        try:
+            db = _unpack_db(data)
+        except Exception as e:
+            # Corrupt document: start over, the next save posts and pins a new one
+            logger.warning("Pinned DB document parse error: %s", e)
+            _DB_CACHE["pinned_id"] = None
+            return {"users": {}, "meta": {}}
+        # Only a document that was read successfully may be overwritten in place
+        _DB_CACHE["pinned_id"] = pinned.message_id
+        _DB_CACHE["file_uid"] = document.file_unique_id
+        return db
+    _DB_CACHE["pinned_id"] = None
+    if pinned and getattr(pinned, "text", None):
+        try:
+            return _unpack_db_text(pinned.text)
+        except Exception as e:
+            logger.warning("Pinned message DB parse error: %s", e)
+            return {"users": {}, "meta": {}}
+    return {"users": {}, "meta": {}}
+
+def _cache_db(db: Dict[str, Any]):
+    # Single pass over users: each string key is converted to int once, then reused
+    # for the name projection and the browse index.
+    index = {"Male": ([], []), "Female": ([], []), "both": ([], [])}
+    names = {}
+    by_id = {}
+    for key, rec in db.get("users", {}).items():
+        uid = int(key)
+        by_id[uid] = rec
+        for field in SET_FIELDS:
+            if field in rec and not isinstance(rec[field], set):
+                rec[field] = set(rec[field])
+        names[uid] = rec.get("name", uid)
+        if rec.get("registered"):
+            gender = rec.get("gender")
+            for bucket in (gender, "both"):
+                if bucket in index:
+                    ids, recs = index[bucket]
+                    ids.append(uid)
+                    recs.append(rec)
+            ids, recs = index.setdefault((gender, rec.get("looking_for")), ([], []))
+            ids.append(uid)
+            recs.append(rec)
+    _DB_CACHE["db"] = db
+    _DB_CACHE["names"] = names
+    _DB_CACHE["by_id"] = by_id
+    _DB_CACHE["ts"] = time.monotonic()
+    _DB_CACHE["index"] = index
+
+def load_db() -> Dict[str, Any]:
+    """
+    Return the cached DB, re-reading the pinned message once the cache is older than DB_CACHE_TTL.
+    Callers that mutate the result must hold _DB_LOCK until save_db() returns.
+    """
+    with _DB_LOCK:
+        if _DB_CACHE["db"] is not None and (
+                time.monotonic() - _DB_CACHE["ts"] < DB_CACHE_TTL
+                or _DB_FLUSH["batch"] or _DB_FLUSH["busy"]):
+            # (never re-read over staged saves that haven't been uploaded yet)
+            return _DB_CACHE["db"]
+        db = _fetch_db()
+        if db is None:
+            if _DB_CACHE["loaded"]:
+                # Read failed: keep serving the cached copy (and its pinned_id/file_uid)
+                # until the next refresh rather than an empty DB
+                _DB_CACHE["ts"] = time.monotonic()
+                return _DB_CACHE["db"]
+            # Nothing read yet and the channel is unreachable: an uncached placeholder,
+            # which save_db() refuses to upload; the next access tries the channel again
+            return {"users": {}, "meta": {}}
+        _DB_CACHE["loaded"] = True
+        if db is _DB_CACHE["db"]:
+            _DB_CACHE["ts"] = time.monotonic()
+        else:
+            _cache_db(db)
+        return db
 
 def save_db(db: Dict[str, Any]) -> bool:
     """
     Write DB JSON into pinned message (create+pin if not exists).
-    Returns True on success.
+    Blocks until the writer thread has uploaded it; returns True on success.
+    Returns False without uploading while the channel copy hasn't been read.
     """
+    with _DB_COND:
+        if not _DB_CACHE["loaded"]:
+            logger.error("save_db skipped: the pinned DB hasn't been read yet.")
+            return False
+        _cache_db(db)
+        batch = _DB_FLUSH["batch"]
+        if batch is None:
+            batch = _DB_FLUSH["batch"] = {"done": False, "ok": False}
+            _DB_COND.notify_all()
+        # wait() drops _DB_LOCK entirely (even if the caller holds it) while the upload runs
+        while not batch["done"]:
+            _DB_COND.wait()
+        return batch["ok"]
+
+def _db_writer():
+    while True:
+        with _DB_COND:
+            while _DB_FLUSH["batch"] is None:
+                _DB_COND.wait()
+            batch, _DB_FLUSH["batch"] = _DB_FLUSH["batch"], None
+            _DB_FLUSH["busy"] = True
+            data = None
+            if _DB_CACHE["loaded"]:
+                try:
+                    data = _pack_db(_DB_CACHE["db"])
+                except Exception as e:
+                    logger.exception("save_db error: %s", e)
+        ok = data is not None and _write_db(data)
+        with _DB_COND:
+            _DB_FLUSH["busy"] = False
+            if not ok:
+                # the cached dict holds the changes that failed to persist, and any staged
+                # since the snapshot; drop them all and re-read the channel copy. The pinned
+                # message may only be edited again once that re-read has succeeded.
+                _DB_CACHE["db"] = None
+                _DB_CACHE["loaded"] = False
+                _DB_CACHE["pinned_id"] = None
+                lost, _DB_FLUSH["batch"] = _DB_FLUSH["batch"], None
+                if lost:
+                    lost["done"] = True
+            batch["ok"], batch["done"] = ok, True
+            _DB_COND.notify_all()
+
+def _pin_db_message(message_id: int):
+    # Pin right away; a 400 (message not visible to pinChatMessage yet) is retried briefly,
+    # a 429 after the flood-wait Telegram asks for
+    for attempt in range(DB_PIN_RETRIES):
+        try:
+            bot.pin_chat_message(DB_CHANNEL_ID, message_id, disable_notification=True)
+            return
+        except ApiTelegramException as e:
+            if e.error_code not in (400, 429) or attempt == DB_PIN_RETRIES - 1:
+                raise
+            if e.error_code == 429:
+                time.sleep((e.result_json or {}).get("parameters", {}).get("retry_after", 1))
+            else:
+                time.sleep(0.05)
+
+def _write_db(data: bytes) -> bool:
     try:
-        text = json.dumps(db, ensure_ascii=False, indent=2)
-        if len(text) > DB_CHAR_LIMIT:
-            logger.error("DB JSON too large (%d > %d).", len(text), DB_CHAR_LIMIT)
+        if len(data) > DB_MAX_BYTES:
+            logger.error("DB too large (%d > %d bytes).", len(data), DB_MAX_BYTES)
             return False
-        pinned = _get_pinned_message()
-        if pinned:
-            bot.edit_message_text(chat_id=DB_CHANNEL_ID, message_id=pinned.message_id, text=text)
-            return True
+        # The pinned id is set by _fetch_db() once it has read the pinned DB document
+        pinned_id = _DB_CACHE["pinned_id"]
+        if pinned_id:
+            try:
+                m = bot.edit_message_media(InputMediaDocument((DB_FILE_NAME, data)), DB_CHANNEL_ID, pinned_id)
+                _DB_CACHE["file_uid"] = m.document.file_unique_id
+            except ApiTelegramException as e:
+                if "message is not modified" not in str(e.description):
+                    _DB_CACHE["pinned_id"] = None  # e.g. unpinned/deleted: post a new one next time
+                    raise
         else:
-            m = bot.send_message(DB_CHANNEL_ID, text)
-            time.sleep(0.5)
-            bot.pin_chat_message(DB_CHANNEL_ID, m.message_id, disable_notification=True)
-            return True
+            # First save, legacy text DB or unreadable document: post and pin a new document
+            # rather than overwrite whatever is pinned now (it stays in the channel history).
+            m = bot.send_document(DB_CHANNEL_ID, data, visible_file_name=DB_FILE_NAME, disable_notification=True)
+            _pin_db_message(m.message_id)
+            pinned_id = m.message_id
+            _DB_CACHE["file_uid"] = m.document.file_unique_id
+        _DB_CACHE["pinned_id"] = pinned_id
+        return True
     except Exception as e:
         logger.exception("save_db error: %s", e)
         return False
 
+threading.Thread(target=_db_writer, name="db-writer", daemon=True).start()
+
 def safe_init_db(created_by) -> bool:
     """
     Initialize DB if it doesn't exist yet. Does not wipe existing data.
     """
-    db = load_db()
-    if db.get("users"):
-        # already exists; update meta only
-        db.setdefault("meta", {})["last_init_by"] = created_by
-        db["meta"]["last_init_at"] = int(time.time())
+    with _DB_LOCK:
+        db = load_db()
+        if db.get("users"):
+            # already exists; update meta only
+            db.setdefault("meta", {})["last_init_by"] = created_by
+            db["meta"]["last_init_at"] = int(time.time())
+            return save_db(db)
+        db = {"users": {}, "meta": {"created_by": created_by, "created_at": int(time.time())}}
         return save_db(db)
-    db = {"users": {}, "meta": {"created_by": created_by, "created_at": int(time.time())}}
-    return save_db(db)
 
 def get_user_record(tgid: int):
-    db = load_db()
-    return db.get("users", {}).get(str(tgid))
+    with _DB_LOCK:
+        load_db()
+        return _DB_CACHE["by_id"].get(tgid)
 
 def save_user_record(tgid: int, record: Dict[str, Any]) -> bool:
-    db = load_db()
-    db.setdefault("users", {})[str(tgid)] = record
-    return save_db(db)
+    with _DB_LOCK:
+        db = load_db()
+        db.setdefault("users", {})[str(tgid)] = record
+        return save_db(db)
 
-def delete_user_record(tgid: int) -> bool:
-    db = load_db()
-    users = db.get("users", {})
-    if str(tgid) in users:
-        del users[str(tgid)]
-        db["users"] = users
+def save_users_bulk(updates: Dict[int, Dict[str, Any]]) -> bool:
+    """Write several user records with a single DB load and a single pinned-message edit."""
+    with _DB_LOCK:
+        db = load_db()
+        db.setdefault("users", {}).update({str(k): v for k, v in updates.items()})
         return save_db(db)
-    return False
+
+def delete_user_record(tgid: int) -> bool:
+    with _DB_LOCK:
+        db = load_db()
+        users = db.get("users", {})
+        if str(tgid) in users:
+            del users[str(tgid)]
+            db["users"] = users
+            return save_db(db)
+        return False
+
+# ---------------- outbound queue ----------------
+OUTBOX_RATE = 30  # messages per second, Telegram's global limit for a bot
+OUTBOX_CHAT_GAP = 1.0  # seconds between queued messages to the same chat
+BROADCAST_RATE = 20  # messages per second for /broadcast, at most; it only gets the slots queue_message() leaves free
+
+# Messages that need not go out inside the update (e.g. the other side of a match) are
+# scheduled here and sent by one background thread, paced globally and per chat.
+# Broadcasts have their own heap, sent from only when nothing in _OUTBOX is due, so a
+# long broadcast never delays match notices.
+_OUTBOX: list = []  # heap of (due, seq, chat_id, text, kwargs)
+_BULK_OUTBOX: list = []  # same, for queue_broadcast()
+_OUTBOX_COND = threading.Condition()
+_OUTBOX_SEQ = itertools.count()
+_CHAT_NEXT_SLOT: Dict[int, float] = {}  # chat_id -> earliest time of its next queued message
+_CHAT_SLOT_LIMIT = 10000  # size that triggers the next prune of _CHAT_NEXT_SLOT
+
+def _push_outbox(heap: list, now: float, chat_id: int, text: str, delay: float, kwargs: Dict[str, Any]):
+    # Caller holds _OUTBOX_COND
+    global _CHAT_SLOT_LIMIT
+    if len(_CHAT_NEXT_SLOT) > _CHAT_SLOT_LIMIT:
+        for cid, slot in list(_CHAT_NEXT_SLOT.items()):
+            if slot < now:
+                del _CHAT_NEXT_SLOT[cid]
+        # Slots still in the future (e.g. a long broadcast) survive the scan; don't rescan
+        # until the dict has doubled again, so pruning stays amortized O(1) per message
+        _CHAT_SLOT_LIMIT = max(10000, 2 * len(_CHAT_NEXT_SLOT))
+    due = max(now + delay, _CHAT_NEXT_SLOT.get(chat_id, 0.0))
+    _CHAT_NEXT_SLOT[chat_id] = due + OUTBOX_CHAT_GAP
+    heapq.heappush(heap, (due, next(_OUTBOX_SEQ), chat_id, text, kwargs))
+
+def queue_message(chat_id: int, text: str, delay: float = 0.0, **kwargs):
+    """Schedule bot.send_message on the outbox thread instead of sending inline (at least delay seconds from now)."""
+    with _OUTBOX_COND:
+        _push_outbox(_OUTBOX, time.monotonic(), chat_id, text, delay, kwargs)
+        _OUTBOX_COND.notify()
+
+def queue_broadcast(chat_ids, text: str, rate: float = BROADCAST_RATE, **kwargs):
+    """Queue text for every chat in chat_ids, spaced 1/rate seconds apart, behind any queue_message() traffic."""
+    with _OUTBOX_COND:
+        now = time.monotonic()
+        for i, chat_id in enumerate(chat_ids):
+            _push_outbox(_BULK_OUTBOX, now, chat_id, text, i / rate, kwargs)
+        _OUTBOX_COND.notify()
+
+def _next_outbox() -> tuple:
+    # Caller holds _OUTBOX_COND; blocks until a message is due, preferring _OUTBOX
+    while True:
+        now = time.monotonic()
+        for heap in (_OUTBOX, _BULK_OUTBOX):
+            if heap and heap[0][0] <= now:
+                return heap, heapq.heappop(heap)
+        heads = [heap[0][0] for heap in (_OUTBOX, _BULK_OUTBOX) if heap]
+        _OUTBOX_COND.wait(min(heads) - now if heads else None)
+
+def _outbox_worker():
+    next_send = 0.0
+    while True:
+        # Pace by deadline rather than sleeping after each round-trip, so slow sends
+        # don't push the rate below OUTBOX_RATE
+        wait = next_send - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        with _OUTBOX_COND:
+            heap, (_, _, chat_id, text, kwargs) = _next_outbox()
+        next_send = max(time.monotonic(), next_send) + 1.0 / OUTBOX_RATE
+        try:
+            bot.send_message(chat_id, text, **kwargs)
+        except ApiTelegramException as e:
+            if e.error_code == 429:
+                # Flood limit: retry once Telegram allows it, in the queue it came from
+                retry_after = (e.result_json or {}).get("parameters", {}).get("retry_after", 1)
+                time.sleep(retry_after)
+                with _OUTBOX_COND:
+                    _push_outbox(heap, time.monotonic(), chat_id, text, 0.0, kwargs)
+            else:
+                logger.warning("Queued message to %s failed. Code: %s, Description: %s", chat_id, e.error_code, e.description)
+        except Exception as e:
+            logger.exception("Queued message to %s failed: %s", chat_id, e)
+
+threading.Thread(target=_outbox_worker, name="outbox", daemon=True).start()
 
 # ---------------- keyboards ----------------
 def main_menu_keyboard():
@@ -176,74 +531,180 @@ def inline_main_menu():
     )
     return markup
 
-def profile_buttons(target_id: int, vip: bool):
+# Values the gender / looking-for buttons can send back
+REG_CHOICES = frozenset(("Male", "Female"))
+
+def _choice_keyboard(prefix: str):
     markup = InlineKeyboardMarkup()
+    markup.row(InlineKeyboardButton("Male", callback_data=f"{prefix}Male"),
+               InlineKeyboardButton("Female", callback_data=f"{prefix}Female"))
+    return markup
+
+# Like/Skip keyboard as pre-serialized JSON; telebot sends a str reply_markup as-is,
+# so VIP cards skip building and serializing two button objects each time.
+_VIP_MARKUP_TPL = ('{{"inline_keyboard":[[{{"text":"❤️ Like","callback_data":"like_{tid}"}},'
+                   '{{"text":"❌ Skip","callback_data":"skip_{tid}"}}]]}}')
+
+def profile_buttons(target_id: int, vip: bool):
     if vip:
-        markup.row(
-            InlineKeyboardButton("❤️ Like", callback_data=f"like_{target_id}"),
-            InlineKeyboardButton("❌ Skip", callback_data=f"skip_{target_id}")
-        )
-    else:
-        markup.row(
-            InlineKeyboardButton("❤️ Like (Preview)", callback_data="fake_like"),
-            InlineKeyboardButton("➡ Next", callback_data="fake_next")
-        )
-        markup.row(InlineKeyboardButton("🌟 Buy VIP", callback_data="buy_vip"))
+        return _VIP_MARKUP_TPL.format(tid=target_id)
+    markup = InlineKeyboardMarkup()
+    markup.row(
+        InlineKeyboardButton("❤️ Like (Preview)", callback_data="fake_like"),
+        InlineKeyboardButton("➡ Next", callback_data="fake_next")
+    )
+    markup.row(InlineKeyboardButton("🌟 Buy VIP", callback_data="buy_vip"))
     return markup
 
+# Static keyboards are built once and shared; telebot only reads them when serializing
+MAIN_MENU_KB = main_menu_keyboard()
+INLINE_MAIN_MENU = inline_main_menu()
+GENDER_KB = _choice_keyboard("reg_gender_")
+LOOKING_FOR_KB = _choice_keyboard("reg_looking_for_")
+
 # ---------------- profile view helpers ----------------
 
-def _send_profile_card(chat_id: int, rec: Dict[str, Any], is_vip: bool, is_own: bool = False, source_id: int = 0):
-    if is_own:
-        caption = (
-            f"<b>Your Profile:</b>\n"
-            f"Name: {rec.get('name')}, Age: {rec.get('age')}\n"
-            f"City: {rec.get('city')}, Gender: {rec.get('gender')}\n"
-            f"Looking for: {rec.get('looking_for')}\n"
-            f"Bio: {rec.get('bio')}"
-        )
-        markup = None # Add edit buttons later if needed
-    else:
-        # Logic for target profile card
-        caption = (
-            f"<b>{rec.get('name')}</b>, {rec.get('age')}\n"
-            f"City: {rec.get('city')}\n"
-            f"Bio: {rec.get('bio')}"
-        )
-        markup = profile_buttons(source_id, is_vip)
-
-    bot.send_photo(chat_id, rec.get("photo_id"), caption=caption, reply_markup=markup)
-
-def _get_next_profile(current_uid: int, db: Dict[str, Any]):
-    # Simplified logic: just cycle through registered users who are not the current user
-    user_uids = [int(uid) for uid in db.get("users", {}).keys() if int(uid) != current_uid]
-    if not user_uids:
-        return None, None
-    
-    # Simple cycle, can be improved with matching logic
-    target_uid = random.choice(user_uids)
-    return target_uid, db["users"][str(target_uid)]
+def _send_photo(chat_id: int, photo: str, **kwargs):
+    """
+    send_photo that remembers the file_id Telegram returns for a remote URL (meta.photo_cache),
+    so later sends reference the stored file instead of Telegram re-downloading the URL.
+    """
+    if not photo or not photo.startswith(("http://", "https://")):
+        return bot.send_photo(chat_id, photo, **kwargs)
+    cached = _cached_photo(photo)
+    m = bot.send_photo(chat_id, cached or photo, **kwargs)
+    if not cached:
+        _remember_photo(photo, m)
+    return m
+
+def _cached_photo(photo: str):
+    return load_db().get("meta", {}).get("photo_cache", {}).get(photo)
+
+def _remember_photo(photo: str, m):
+    if not photo or not photo.startswith(("http://", "https://")) or not getattr(m, "photo", None):
+        return
+    file_id = m.photo[-1].file_id
+    with _DB_LOCK:
+        db = load_db()
+        cache = db.setdefault("meta", {}).setdefault("photo_cache", {})
+        if cache.get(photo) == file_id:
+            return  # already stored: don't re-upload the DB for nothing
+        cache[photo] = file_id
+        save_db(db)
+
+def _send_profile_card(chat_id: int, rec: Dict[str, Any]):
+    # The user's own card (/profile); browsed profiles go through _edit_browse_view()
+    caption = (
+        f"<b>Your Profile:</b>\n"
+        f"Name: {rec.get('name')}, Age: {rec.get('age')}\n"
+        f"City: {rec.get('city')}, Gender: {rec.get('gender')}\n"
+        f"Looking for: {rec.get('looking_for')}\n"
+        f"Bio: {escape(str(rec.get('bio')))}"
+    )
+    _send_photo(chat_id, rec.get("photo_id"), caption=caption, reply_markup=None)  # Add edit buttons later if needed
+
+def _profile_caption(rec: Dict[str, Any]) -> str:
+    return _build_caption(rec.get('name'), rec.get('age'), rec.get('city'), rec.get('bio'))
+
+@functools.lru_cache(maxsize=4096)
+def _build_caption(name, age, city, bio) -> str:
+    # Same profile is shown to many browsers: format (and HTML-escape the free-text bio) once
+    return (
+        f"<b>{name}</b>, {age}\n"
+        f"City: {city}\n"
+        f"Bio: {escape(str(bio))}"
+    )
 
-def _send_browse_view(uid: int):
-    db = load_db()
-    current_user = get_user_record(uid)
-    is_vip = current_user.get("vip", False)
+_TAG_RE = re.compile(r"<[^>]+>")
+
+def _plain_caption(caption: str) -> str:
+    # The caption text Telegram reports back (message.caption) for one of our HTML captions
+    return unescape(_TAG_RE.sub("", caption))
+
+# Fake cards never change: pre-render (photo, caption, plain caption) per looking_for and
+# share one keyboard
+def _fake_card(p: Dict[str, Any]):
+    caption = _profile_caption(p)
+    return p["photo"], caption, _plain_caption(caption)
+
+FAKE_POOLS = {
+    "Male": [_fake_card(p) for p in FAKE_PROFILES_MALE],
+    "Female": [_fake_card(p) for p in FAKE_PROFILES_FEMALE],
+}
+FAKE_POOLS["both"] = FAKE_POOLS["Male"] + FAKE_POOLS["Female"]
+FAKE_PROFILE_MARKUP = profile_buttons(0, vip=False)
+
+def _get_next_profile(current_uid: int, looking_for: str, gender: str = None):
+    # Random registered user of the wanted gender, other than the current user; users
+    # of that gender who are looking for the current user's gender come first
+    with _DB_LOCK:
+        load_db()  # refreshes the index if the cache expired
+        index = _DB_CACHE["index"]
+        ids, recs = index.get((looking_for, gender)) or ([], [])
+        if not ids or ids == [current_uid]:
+            ids, recs = index.get(looking_for) or index["both"]
+    n = len(ids)
+    if not n:
+        return None, None
+    i = random.randrange(n)
+    if ids[i] == current_uid:
+        if n == 1:
+            return None, None
+        i = (i + random.randrange(1, n)) % n
+    return ids[i], recs[i]
+
+def _next_browse_card(uid: int, shown: str = None):
+    """
+    (photo, caption, markup) of the next card to show uid, or None if nobody is registered.
+    shown is the caption of the card on screen; a different card is preferred when there is one.
+    """
+    current_user = get_user_record(uid) or {}
+    looking_for, gender = current_user.get("looking_for"), current_user.get("gender")
 
-    target_uid, target_rec = _get_next_profile(uid, db)
+    target_uid, target_rec = _get_next_profile(uid, looking_for, gender)
+    if not target_rec:
+        return None
+    # VIP user sees real profiles
+    if current_user.get("vip", False):
+        caption = _profile_caption(target_rec)
+        for _ in range(3):
+            if shown is None or _plain_caption(caption) != shown:
+                break
+            target_uid, target_rec = _get_next_profile(uid, looking_for, gender)
+            caption = _profile_caption(target_rec)
+        return target_rec.get("photo_id"), caption, profile_buttons(target_uid, True)
+    # Free user sees fake profiles
+    pool = FAKE_POOLS.get(looking_for) or FAKE_POOLS["both"]
+    photo, caption, _ = random.choice([c for c in pool if c[2] != shown] or pool)
+    return photo, caption, FAKE_PROFILE_MARKUP
 
-    if target_rec:
-        # VIP user sees real profiles
-        if is_vip:
-            _send_profile_card(uid, target_rec, is_vip=True, source_id=target_uid)
-        # Free user sees fake profiles
-        else:
-            fake_list = FAKE_PROFILES_FEMALE if current_user.get("looking_for") == "Male" else FAKE_PROFILES_MALE
-            fake_rec = random.choice(fake_list)
-            fake_rec['photo_id'] = fake_rec.pop('photo')
-            _send_profile_card(uid, fake_rec, is_vip=False)
+def _send_browse_view(uid: int):
+    card = _next_browse_card(uid)
+    if card:
+        photo, caption, markup = card
+        _send_photo(uid, photo, caption=caption, reply_markup=markup)
     else:
         bot.send_message(uid, "No profiles found yet. Try again later.")
 
+def _edit_browse_view(call, uid: int):
+    """Turn the card under call's buttons into the next one with a single editMessageMedia."""
+    card = _next_browse_card(uid, call.message.caption)
+    if card:
+        photo, caption, markup = card
+        cached = _cached_photo(photo) if photo else None
+        try:
+            m = bot.edit_message_media(InputMediaPhoto(cached or photo, caption=caption, parse_mode="HTML"),
+                                       call.message.chat.id, call.message.message_id, reply_markup=markup)
+            if not cached:
+                _remember_photo(photo, m)
+            return
+        except ApiTelegramException as e:
+            if "message is not modified" in str(e.description):
+                return  # only one card to show and it's already on screen
+            # e.g. the card is too old to edit: fall back to posting a new one
+            logger.warning("Browse card edit failed. Code: %s, Description: %s", e.error_code, e.description)
+    _send_browse_view(uid)
+
 
 # ---------------- bot handlers ----------------
 
@@ -257,7 +718,7 @@ def cmd_start(message):
     # Try to send a message immediately to catch the blocked user error (403)
     try:
         if rec and rec.get("registered"):
-            bot.send_message(uid, f"Welcome back, <b>{rec.get('name')}</b>! Use /profiles to browse.", reply_markup=main_menu_keyboard())
+            bot.send_message(uid, f"Welcome back, <b>{rec.get('name')}</b>! Use /profiles to browse.", reply_markup=MAIN_MENU_KB)
             return
     except ApiTelegramException as e:
         # This will catch the 403 (blocked) or other errors and log them clearly.
@@ -270,11 +731,15 @@ def cmd_start(message):
     
     # If not registered, start registration flow
     if not rec or not rec.get("registered"):
-        TEMP_BUFFER[uid] = {"tgid": uid}
-        REG_STEP[uid] = "photo"
+        _start_registration(uid)
         bot.send_message(uid, "👋 Welcome! Let's create your dating profile.\n\nStep 1: Send your profile photo (mandatory).", reply_markup=None)
 
 
+@bot.message_handler(commands=["help"])
+def cmd_help(message):
+    bot.send_message(message.from_user.id, HELP_TEXT, reply_markup=MAIN_MENU_KB)
+
+
 @bot.message_handler(commands=["init_db"])
 def cmd_init_db(message):
     """Admin command to initialize the database pinned message."""
@@ -293,6 +758,25 @@ def cmd_init_db(message):
     # --- DIAGNOSTIC END ---
 
 
+@bot.message_handler(commands=["broadcast"])
+def cmd_broadcast(message):
+    """Admin command: /broadcast <text> to every registered user, sent from the outbox."""
+    if message.from_user.id not in ADMIN_IDS:
+        bot.reply_to(message, "Admin only.")
+        return
+    text = message.text.partition(" ")[2].strip()
+    if not text:
+        bot.reply_to(message, "Usage: /broadcast <message>")
+        return
+
+    with _DB_LOCK:
+        load_db()
+        targets = _DB_CACHE["index"]["both"][0]
+    # Sent at BROADCAST_RATE at most, and only while no match notification is waiting
+    queue_broadcast(targets, text)
+    bot.reply_to(message, f"Broadcast queued for {len(targets)} users.")
+
+
 @bot.message_handler(commands=["profile"])
 def cmd_profile(message):
     uid = message.from_user.id
@@ -300,9 +784,8 @@ def cmd_profile(message):
     if not rec or not rec.get("registered"):
         bot.reply_to(message, "Please use /start to register first.")
         return
-    
-    is_vip = rec.get("vip", False)
-    _send_profile_card(uid, rec, is_vip=is_vip, is_own=True)
+
+    _send_profile_card(uid, rec)
 
 
 @bot.message_handler(commands=["profiles"])
@@ -316,6 +799,23 @@ def cmd_profiles(message):
     _send_browse_view(uid)
 
 
+@bot.message_handler(commands=["matches"])
+def cmd_matches(message):
+    uid = message.from_user.id
+    rec = get_user_record(uid)
+    if not rec or not rec.get("registered"):
+        bot.reply_to(message, "Please use /start to register first.")
+        return
+
+    matches = rec.get("matches")
+    if not matches:
+        bot.reply_to(message, "No matches yet. Keep browsing with /profiles.")
+        return
+    names = _DB_CACHE["names"]
+    lines = [f"• {names.get(m, m)}" for m in matches]
+    bot.send_message(uid, "<b>Your matches:</b>\n" + "\n".join(lines))
+
+
 # ---------------- Registration Handlers ----------------
 
 @bot.message_handler(content_types=['photo'])
@@ -332,86 +832,99 @@ def handle_photo_reg(message):
     # Fallthrough to default handlers if not in registration
 
 
+def _step_name(uid: int, text: str, buf: Dict[str, Any]):
+    if 2 <= len(text) <= 50 and text.isalpha():
+        buf["name"] = text
+        bot.send_message(uid, "Step 3: Enter your age (18-99).")
+        return "age"
+    bot.send_message(uid, "Invalid name. Please enter a valid name (letters only).")
+    return "name"
+
+def _step_age(uid: int, text: str, buf: Dict[str, Any]):
+    age = int(text) if text.isdigit() else 0
+    if 18 <= age <= 99:
+        buf["age"] = age
+        bot.send_message(uid, "Step 4: Select your gender.", reply_markup=GENDER_KB)
+        return "gender"
+    bot.send_message(uid, "Invalid age. Must be a number between 18 and 99.")
+    return "age"
+
+def _step_city(uid: int, text: str, buf: Dict[str, Any]):
+    # Letters (str.isalpha) and whitespace; split/join + isalpha run in C instead of a per-char loop
+    if 2 <= len(text) <= 50 and "".join(text.split()).isalpha():
+        buf["city"] = text
+        bot.send_message(uid, "Step 6: Write a short bio (max 200 characters).")
+        return "bio"
+    bot.send_message(uid, "Invalid city. Please enter a valid city name.")
+    return "city"
+
+def _step_bio(uid: int, text: str, buf: Dict[str, Any]):
+    if not 5 <= len(text) <= 200:
+        bot.send_message(uid, "Bio too short or too long. Must be between 5 and 200 characters.")
+        return "bio"
+    buf["bio"] = text
+    buf["vip"] = False
+    buf["likes"] = []
+    buf["matches"] = []
+    buf["registered"] = True
+
+    # Final Save
+    if save_user_record(uid, buf):
+        bot.send_message(uid, "🎉 Registration complete! You can now start browsing profiles using /profiles.", reply_markup=MAIN_MENU_KB)
+    else:
+        bot.send_message(uid, "❌ Error saving your profile. Please try again later.")
+    return None
+
+# Text-input registration steps: each handler validates the reply and returns the next step
+# (the same step to re-ask, None once registration is finished).
+STEP_HANDLERS = {
+    "name": _step_name,
+    "age": _step_age,
+    "city": _step_city,
+    "bio": _step_bio,
+}
+
+
 @bot.message_handler(content_types=['text'])
 def handle_text_messages(message):
     uid = message.from_user.id
     text = message.text
-    current_step = REG_STEP.get(uid)
 
-    if current_step == "name":
-        if 2 <= len(text) <= 50 and text.isalpha():
-            TEMP_BUFFER[uid]["name"] = text
-            REG_STEP[uid] = "age"
-            bot.send_message(uid, "Step 3: Enter your age (18-99).")
-        else:
-            bot.send_message(uid, "Invalid name. Please enter a valid name (letters only).")
-        return
-    
-    elif current_step == "age":
-        if text.isdigit() and 18 <= int(text) <= 99:
-            TEMP_BUFFER[uid]["age"] = int(text)
-            REG_STEP[uid] = "gender"
-            markup = InlineKeyboardMarkup()
-            markup.row(InlineKeyboardButton("Male", callback_data="reg_gender_Male"),
-                       InlineKeyboardButton("Female", callback_data="reg_gender_Female"))
-            bot.send_message(uid, "Step 4: Select your gender.", reply_markup=markup)
-        else:
-            bot.send_message(uid, "Invalid age. Must be a number between 18 and 99.")
-        return
-    
-    elif current_step == "city":
-        if 2 <= len(text) <= 50 and all(c.isalpha() or c.isspace() for c in text):
-            TEMP_BUFFER[uid]["city"] = text
-            REG_STEP[uid] = "bio"
-            bot.send_message(uid, "Step 6: Write a short bio (max 200 characters).")
-        else:
-            bot.send_message(uid, "Invalid city. Please enter a valid city name.")
+    # Known commands have their own handlers; answer the rest before any state or DB lookup
+    if text[0] == "/":
+        bot.send_message(uid, "Unknown command. Use /menu to see options.")
         return
 
-    elif current_step == "bio":
-        if 5 <= len(text) <= 200:
-            TEMP_BUFFER[uid]["bio"] = text
-            TEMP_BUFFER[uid]["vip"] = False
-            TEMP_BUFFER[uid]["likes"] = []
-            TEMP_BUFFER[uid]["matches"] = []
-            TEMP_BUFFER[uid]["registered"] = True
-            
-            # Final Save
-            ok = save_user_record(uid, TEMP_BUFFER[uid])
-            
-            del REG_STEP[uid]
-            del TEMP_BUFFER[uid]
-
-            if ok:
-                bot.send_message(uid, "🎉 Registration complete! You can now start browsing profiles using /profiles.", reply_markup=main_menu_keyboard())
-            else:
-                bot.send_message(uid, "❌ Error saving your profile. Please try again later.")
+    handler = STEP_HANDLERS.get(REG_STEP.get(uid))
+    if handler:
+        next_step = handler(uid, text.strip(), TEMP_BUFFER[uid])
+        if next_step is None:
+            _clear_registration(uid)
         else:
-            bot.send_message(uid, "Bio too short or too long. Must be between 5 and 200 characters.")
+            REG_STEP[uid] = next_step
         return
 
     # Catch-all for non-command text
-    if not text.startswith('/'):
-        rec = get_user_record(uid)
-        if not rec or not rec.get("registered"):
-            bot.send_message(uid, "Please use /start to begin registration.")
-        else:
-            bot.send_message(uid, "I'm not sure what to do with that. Use /menu to see options.")
+    rec = get_user_record(uid)
+    if not rec or not rec.get("registered"):
+        bot.send_message(uid, "Please use /start to begin registration.")
+    else:
+        bot.send_message(uid, "I'm not sure what to do with that. Use /menu to see options.")
 
 
 # ---------------- Callback Handlers ----------------
 
-def _handle_registration_callback(call, data, uid):
-    # Handles gender and looking_for selection
-    _, step, value = data.split('_')
-    
+def _cb_registration(call, arg, uid):
+    # Handles gender and looking_for selection ("gender_Male", "looking_for_Both")
+    step, _, value = arg.rpartition('_')
+    if REG_STEP.get(uid) != step or value not in REG_CHOICES:
+        bot.answer_callback_query(call.id, "This step has expired. Start again with /start.")
+        return
+
     if step == "gender":
         TEMP_BUFFER[uid]["gender"] = value
         REG_STEP[uid] = "looking_for"
-        markup = InlineKeyboardMarkup()
-        markup.row(InlineKeyboardButton("Male", callback_data="reg_looking_for_Male"),
-                   InlineKeyboardButton("Female", callback_data="reg_looking_for_Female"))
-        bot.edit_message_text("Step 5: Select who you are looking for.", call.message.chat.id, call.message.message_id, reply_markup=markup)
+        bot.edit_message_text("Step 5: Select who you are looking for.", call.message.chat.id, call.message.message_id, reply_markup=LOOKING_FOR_KB)
         
     elif step == "looking_for":
         TEMP_BUFFER[uid]["looking_for"] = value
@@ -419,124 +932,140 @@ def _handle_registration_callback(call, data, uid):
         bot.edit_message_text("Step 6: Enter your city.", call.message.chat.id, call.message.message_id, reply_markup=None)
 
 
-def _handle_like_skip(call, data, uid):
-    _, action, target_id_str = data.split('_')
-    target_id = int(target_id_str)
-    
-    # Load DB
-    db = load_db()
-    
-    # Handle Like
-    if action == "like":
-        user_record = db["users"].get(str(uid), {})
-        target_record = db["users"].get(str(target_id), {})
-        
-        # Add like to user's list
-        if target_id not in user_record.get("likes", []):
-            user_record.setdefault("likes", []).append(target_id)
+def _cb_like(call, arg, uid):
+    target_id = int(arg)
+
+    # Hold the DB lock from read to write so concurrent likes don't clobber each other
+    with _DB_LOCK:
+        user_record = get_user_record(uid) or {}
+        target_record = get_user_record(target_id) or {}
+
+        # Add like to user's set
+        user_record.setdefault("likes", set()).add(target_id)
 
         # Check for match (if target already liked current user)
-        if uid in target_record.get("likes", []):
-            # Match found
-            user_record.setdefault("matches", []).append(target_id)
-            target_record.setdefault("matches", []).append(uid)
-            
-            # Notify both users
-            bot.send_message(uid, f"🎉 **MATCH!** You matched with {target_record.get('name')}! You can chat with them.")
-            bot.send_message(target_id, f"🎉 **MATCH!** You matched with {user_record.get('name')}! Chat with them here.")
-        
-        db["users"][str(uid)] = user_record
-        db["users"][str(target_id)] = target_record
-
-        # Save and update view
-        if save_db(db):
-            bot.answer_callback_query(call.id, "Liked!")
-            bot.edit_message_caption(call.message.chat.id, call.message.message_id, caption="Liked!", reply_markup=None)
-            _send_browse_view(uid)
-        else:
-            bot.answer_callback_query(call.id, "Error saving like.")
-    
-    # Handle Skip
-    elif action == "skip":
-        bot.answer_callback_query(call.id, "Skipped.")
-        bot.edit_message_caption(call.message.chat.id, call.message.message_id, caption="Skipped!", reply_markup=None)
-        _send_browse_view(uid)
+        matched = uid in target_record.get("likes", ())
+        if matched:
+            user_record.setdefault("matches", set()).add(target_id)
+            target_record.setdefault("matches", set()).add(uid)
+
+        # One pinned-message edit for both records, match or not
+        saved = save_users_bulk({uid: user_record, target_id: target_record})
+
+    # Save and update view
+    if saved:
+        if matched:
+            # Notify both users from the outbox, off this callback's path
+            queue_message(uid, f"🎉 **MATCH!** You matched with {target_record.get('name')}! You can chat with them.")
+            queue_message(target_id, f"🎉 **MATCH!** You matched with {user_record.get('name')}! Chat with them here.")
+        bot.answer_callback_query(call.id, "Liked!")
+        _edit_browse_view(call, uid)
+    else:
+        bot.answer_callback_query(call.id, "Error saving like.")
+
+
+def _cb_skip(call, arg, uid):
+    bot.answer_callback_query(call.id, "Skipped.")
+    _edit_browse_view(call, uid)
 
 
-def _handle_admin_callback(call, data, uid):
+def _handle_admin_callback(call, uid):
     # Admin callback logic (not fully implemented here, but reserved)
     bot.answer_callback_query(call.id, "Admin feature not active.")
-    bot.edit_message_text("Admin Menu", call.message.chat.id, call.message.message_id, reply_markup=inline_main_menu())
+    bot.edit_message_text("Admin Menu", call.message.chat.id, call.message.message_id, reply_markup=INLINE_MAIN_MENU)
+
+
+def _cb_menu(call, arg, uid):
+    if arg == "browse":
+        bot.edit_message_text("Starting to browse...", call.message.chat.id, call.message.message_id, reply_markup=None)
+        _send_browse_view(uid)
+    elif arg == "admin" and uid in ADMIN_IDS:
+        _handle_admin_callback(call, uid)
+    else:
+        bot.answer_callback_query(call.id, f"Menu action: {call.data} not fully implemented.")
+        bot.edit_message_text(f"Welcome to the {arg} menu!", call.message.chat.id, call.message.message_id, reply_markup=INLINE_MAIN_MENU)
+
+
+def _cb_fake(call, arg, uid):
+    # fake_like / fake_next: placeholder cards shown to free users
+    bot.answer_callback_query(call.id, "Profiles for VIP members only. Use /buy to upgrade.")
+    _edit_browse_view(call, uid)
+
+
+def _cb_buy(call, arg, uid):
+    bot.answer_callback_query(call.id, "Redirecting to payment link...")
+    bot.send_message(uid, "Buy VIP: [Link to Payment Placeholder]")
+
+
+# callback_data is "<prefix>_<arg>"; routed on the prefix with one dict lookup
+CB_HANDLERS = {
+    "reg": _cb_registration,
+    "like": _cb_like,
+    "skip": _cb_skip,
+    "menu": _cb_menu,
+    "fake": _cb_fake,
+    "buy": _cb_buy,
+}
 
 
 @bot.callback_query_handler(func=lambda call: True)
 def handle_callback_query(call):
     uid = call.from_user.id
-    data = call.data
-    
-    # Cancel any pending registration text step
-    if uid in REG_STEP:
-        del REG_STEP[uid]
-        bot.send_message(uid, "Registration interrupted. Start again with /start.")
-        
-    if data.startswith("reg_"):
-        _handle_registration_callback(call, data, uid)
-    
-    elif data.startswith("like_") or data.startswith("skip_"):
-        _handle_like_skip(call, data, uid)
-    
-    elif data.startswith("menu_"):
-        if data == "menu_browse":
-            bot.edit_message_text("Starting to browse...", call.message.chat.id, call.message.message_id, reply_markup=None)
-            _send_browse_view(uid)
-        else:
-            bot.answer_callback_query(call.id, f"Menu action: {data} not fully implemented.")
-            bot.edit_message_text(f"Welcome to the {data.split('_')[1]} menu!", call.message.chat.id, call.message.message_id, reply_markup=inline_main_menu())
-
-    elif data == "fake_like" or data == "fake_next":
-        bot.answer_callback_query(call.id, "Profiles for VIP members only. Use /buy to upgrade.")
-        _send_browse_view(uid)
+    key, _, arg = call.data.partition("_")
 
-    elif data == "buy_vip":
-        bot.answer_callback_query(call.id, "Redirecting to payment link...")
-        bot.send_message(uid, "Buy VIP: [Link to Payment Placeholder]")
+    # Cancel any pending registration text step (button steps are part of registration)
+    if key != "reg" and uid in REG_STEP:
+        _clear_registration(uid)
+        bot.send_message(uid, "Registration interrupted. Start again with /start.")
 
-    elif data == "menu_admin" and uid in ADMIN_IDS:
-        _handle_admin_callback(call, data, uid)
-    
+    handler = CB_HANDLERS.get(key)
+    if handler:
+        handler(call, arg, uid)
     else:
         bot.answer_callback_query(call.id, "Unknown command.")
 
 
-# ---------------- Fallback Handler ----------------
-# This must be the last handler
-@bot.message_handler(func=lambda message: True)
-def echo_all(message):
-    uid = message.from_user.id
-    rec = get_user_record(uid)
-    if not rec or not rec.get("registered"):
-        # If user sends non-command, non-photo, and isn't registered, prompt /start
-        if not message.text.startswith('/'):
-            bot.send_message(uid, "Welcome! Use /start to begin registration.")
-        else:
-            # Handle unknown command
-            bot.send_message(uid, "Unknown command. Use /menu to see options.")
-    else:
-        # Registered user sends non-command text
-        bot.send_message(uid, "I'm not sure what to do with that. Use /menu to see options.")
+# ---------------- webhook + health endpoits ----------------
+UPDATE_SHARDS = max(1, int(os.getenv("HANDLER_THREADS", "16")))  # single-thread executors; one chat always maps to the same shard
 
+# Updates are handled off the request thread so the webhook answers Telegram at once.
+# Sharding by chat keeps each user's updates in order while other chats run in parallel.
+_UPDATE_EXECUTORS = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"update-{i}") for i in range(UPDATE_SHARDS)]
+# Bound on accepted-but-unprocessed updates; past it the webhook answers 503 and Telegram
+# redelivers later instead of the executors' queues growing without limit.
+MAX_PENDING_UPDATES = 10000
+_UPDATE_SLOTS = threading.BoundedSemaphore(MAX_PENDING_UPDATES)
+
+def _process_update(update):
+    try:
+        if update.message:
+            bot.process_new_messages([update.message])
+        elif update.callback_query:
+            bot.process_new_callback_query([update.callback_query])
+    except Exception as e:
+        logger.exception("Update %s failed: %s", update.update_id, e)
+    finally:
+        _UPDATE_SLOTS.release()
+
+def _update_chat_id(update) -> int:
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        return update.callback_query.from_user.id
+    return 0
 
-# ---------------- webhook + health endpoits ----------------
 @app.route(f"/{BOT_TOKEN}", methods=['POST'])
 def webhook():
-    json_data = request.get_json(force=True)
+    # orjson parses the raw body bytes directly; de_json accepts the resulting dict
+    try:
+        json_data = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError:
+        return "Bad Request", 400
     update = telebot.types.Update.de_json(json_data)
-    
-    if update.message:
-        bot.process_new_messages([update.message])
-    elif update.callback_query:
-        bot.process_new_callback_query([update.callback_query])
-
+    if not _UPDATE_SLOTS.acquire(blocking=False):
+        logger.warning("Update backlog full (%d), asking Telegram to retry.", MAX_PENDING_UPDATES)
+        return "Busy", 503
+    _UPDATE_EXECUTORS[_update_chat_id(update) % UPDATE_SHARDS].submit(_process_update, update)
     return "OK", 200
     
 
@@ -549,17 +1078,21 @@ def healthz():
     return "OK", 200
 
 # ---------------- set webhook (executed on import) ----------------
+WEBHOOK_MAX_CONN = int(os.getenv("WEBHOOK_MAX_CONN", "40"))  # parallel webhook requests Telegram may open
+WEBHOOK_UPDATES = ["message", "callback_query"]  # the only update types _process_update handles
+
 def set_webhook():
     try:
         full = f"{WEBHOOK_URL.rstrip('/')}/{BOT_TOKEN}"
-        logger.info("Removing existing webhook (if any)...")
-        try:
-            bot.remove_webhook()
-        except Exception:
-            pass
-        time.sleep(0.7)
+        # Restarts and redeploys usually find the webhook already in place; leave it alone then
+        info = bot.get_webhook_info()
+        if (info.url == full and info.max_connections == WEBHOOK_MAX_CONN
+                and sorted(info.allowed_updates or ()) == sorted(WEBHOOK_UPDATES)):
+            logger.info("Webhook already set to %s", full)
+            return
+        # setWebhook replaces any previous registration, so no removeWebhook + sleep first
         logger.info("Setting webhook to %s", full)
-        bot.set_webhook(url=full)
+        bot.set_webhook(url=full, max_connections=WEBHOOK_MAX_CONN, allowed_updates=WEBHOOK_UPDATES)
         logger.info("Webhook set successfully.")
     except Exception as e:
         logger.exception("Failed to set webhook: %s", e)